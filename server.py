@@ -1,114 +1,519 @@
 import asyncio
 import websockets
-import json
+from websockets.frames import Frame, Opcode
+from websockets.protocol import State
 import os
-from datetime import datetime
-
+import re
+import time
+import hashlib
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Optional, Union
+
+import ahocorasick
+import msgspec
+import orjson
 import requests as http_requests
-from openai import OpenAI
+from openai import AsyncOpenAI
 from better_profanity import profanity
 
-from google.oauth2 import id_token
+from google.auth import jwt
 from google.auth.transport import requests as google_requests
 
 from dotenv import load_dotenv
 load_dotenv()
 
+# Optional: run toxic-bert locally with ONNX Runtime instead of the HF API
+try:
+    import numpy as np
+    import onnxruntime as ort
+    from transformers import AutoConfig, AutoTokenizer
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+except ImportError:
+    ort = None
+
 # === Config ===
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 HF_API_KEY = os.getenv("HF_API_KEY")
-client = OpenAI()
+client = AsyncOpenAI()
 
 HOST = "127.0.0.1"
 PORT = 12345
 FLAGGED_LOG_PATH = "flagged_messages.log"
+TOXIC_BERT_MODEL = "unitary/toxic-bert"
+TOXIC_BERT_DIR = os.path.expanduser("~/.cache/toxic_bert_onnx")
+TOXICITY_THRESHOLD = 0.5
+TOX_BATCH_SIZE = 16
+TOX_BATCH_WINDOW = 0.01
+SAFETY_CACHE_SIZE = 8192
+FAST_PATH_MAX_LEN = 20
+# Under one message per second on average, so a client pacing itself at ~1 s still trips it
+RATE_LIMIT_MESSAGES = 8    # max chat messages ...
+RATE_LIMIT_WINDOW = 10     # ... per this many seconds
+SEND_QUEUE_SIZE = 256
+LOG_BATCH_SIZE = 64
+CLOCK_TICK = 0.1
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_CERTS_TTL = 3600   # used when the certs response carries no Cache-Control max-age
+GOOGLE_CERTS_MIN_REFRESH = 60   # at most one early refetch per minute for unknown key ids
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
 
 # === State ===
-clients = []
+clients = set()
 users = {}   # ws -> {email,name,pic}
+online_emails = set()
 unsafe_counts = {}
 rate_limit_counts = {}
-last_message_times = {}
+msg_times = {}   # ws -> deque of recent send times (time.monotonic())
+send_queues = {}   # ws -> asyncio.Queue of outbound (message, frame bytes, close after) items
+send_tasks = {}    # ws -> task draining send_queues[ws]
+background_tasks = set()   # strong refs so fire-and-forget tasks are not garbage collected
 banned_emails = set()
+_token_cache = {}   # sha256(token) -> (expires_at, user)
+_google_certs = (0.0, 0.0, {})   # (fetched_at, expires_at, {key id: x509 cert})
+_google_request = google_requests.Request()
+_tox_queue = None   # (text, future) pairs for tox_worker, created in main()
+_tox_cache = OrderedDict()   # text -> toxic score, LRU
+_log_q = None   # flagged-message lines for log_writer, created in main()
+_user_list_cache = None   # serialized user_list message, reset whenever users changes
+_now_iso = datetime.now(timezone.utc).isoformat()   # refreshed by tick_clock()
+
+TOKEN_CACHE_TTL = 300
+
+# === Client messages ===
+class AuthMsg(msgspec.Struct, tag="auth"):
+    token: Optional[str] = None   # a null token is a failed sign-in, not a malformed message
+
+
+class ChatMsg(msgspec.Struct, tag="chat"):
+    content: str = ""
+
+
+# Dispatches on the "type" field; unknown types and malformed JSON raise msgspec.DecodeError
+decode_client_msg = msgspec.json.Decoder(Union[AuthMsg, ChatMsg]).decode
 
 # === Profanity ===
 profanity.load_censor_words()
 
 
-def verify_google_token(token: str):
+# Fold every substitute in profanity.CHARS_MAPPING onto one key per look-alike class.
+# '*' may stand in for any vowel, and '@' for a or o, '1' for i or l, 'u' and 'v' for
+# each other, so the vowels, l, v and their symbols all collapse onto '*'.
+LEET_TABLE = str.maketrans({
+    **dict.fromkeys("aeiouvl@0134", "*"),
+    "$": "s", "5": "s",
+    "7": "t",
+})
+
+
+def build_profanity_automaton():
+    """Compile the folded censor word list into a single Aho-Corasick automaton."""
+    folded = {}
+    for entry in profanity.CENSOR_WORDSET:
+        folded.setdefault(str(entry).translate(LEET_TABLE), []).append(entry)
+    automaton = ahocorasick.Automaton()
+    for word, entries in folded.items():
+        automaton.add_word(word, (len(word), entries))
+    automaton.make_automaton()
+    return automaton
+
+
+PROFANITY_AUTOMATON = build_profanity_automaton()
+# better_profanity's words are runs of ALLOWED_CHARACTERS; anything else separates them
+PROFANITY_WORD_RE = re.compile("[%s]+" % re.escape("".join(sorted(profanity.ALLOWED_CHARACTERS))))
+
+
+# === Toxicity model ===
+def load_toxic_bert():
+    """Export toxic-bert to ONNX once and open an inference session on it."""
+    if ort is None:
+        return None, None, None
     try:
-        idinfo = id_token.verify_oauth2_token(
-            token,
-            google_requests.Request(),
-            GOOGLE_CLIENT_ID,
-            clock_skew_in_seconds=10  
-        )
-        return {
-            "email": idinfo.get("email"),
-            "name": idinfo.get("name", idinfo.get("email", "User")),
-            "pic": idinfo.get("picture", "")
-        }
+        model_path = os.path.join(TOXIC_BERT_DIR, "model.onnx")
+        if not os.path.exists(model_path):
+            model = ORTModelForSequenceClassification.from_pretrained(TOXIC_BERT_MODEL, export=True)
+            model.save_pretrained(TOXIC_BERT_DIR)
+            AutoTokenizer.from_pretrained(TOXIC_BERT_MODEL).save_pretrained(TOXIC_BERT_DIR)
+        tokenizer = AutoTokenizer.from_pretrained(TOXIC_BERT_DIR)
+        toxic_index = AutoConfig.from_pretrained(TOXIC_BERT_DIR).label2id["toxic"]
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(model_path, opts, providers=["CPUExecutionProvider"])
+        return session, tokenizer, toxic_index
+    except Exception as e:
+        print("Local toxic-bert unavailable, using Hugging Face API:", e)
+        return None, None, None
+
+
+tox_session, tox_tokenizer, tox_index = load_toxic_bert()
+
+# Pooled connection for the remote fallback, so each batch skips the TCP/TLS handshake
+_hf_session = http_requests.Session()
+_hf_session.headers["Authorization"] = f"Bearer {HF_API_KEY}"
+
+
+def _prune_token_cache(now):
+    for h in [h for h, (expires_at, _) in _token_cache.items() if expires_at <= now]:
+        _token_cache.pop(h, None)
+
+
+def get_google_certs(now, refresh=False):
+    """Google's signing certs, cached for the max-age Google sends with them."""
+    global _google_certs
+    fetched_at, expires_at, certs = _google_certs
+    if expires_at <= now or (refresh and now - fetched_at >= GOOGLE_CERTS_MIN_REFRESH):
+        response = _google_request(GOOGLE_CERTS_URL, method="GET")
+        if response.status != 200:
+            raise ValueError(f"Could not fetch Google certs: HTTP {response.status}")
+        certs = orjson.loads(response.data)
+        max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        ttl = int(max_age.group(1)) if max_age else GOOGLE_CERTS_TTL
+        _google_certs = (now, now + ttl, certs)
+    return certs
+
+
+def decode_google_token(token: str):
+    # Same checks as id_token.verify_oauth2_token, minus the cert fetch per call
+    now = time.time()
+    certs = get_google_certs(now)
+    kid = jwt.decode_header(token).get("kid")
+    if kid and kid not in certs:
+        # Google rotated its keys before our copy expired
+        certs = get_google_certs(now, refresh=True)
+    idinfo = jwt.decode(
+        token,
+        certs=certs,
+        audience=GOOGLE_CLIENT_ID,
+        clock_skew_in_seconds=10
+    )
+    if idinfo.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+    return idinfo
+
+
+async def verify_google_token(token: str):
+    if not isinstance(token, str) or not token:
+        return None
+    # The cache is only touched here on the event loop; just the decode runs in a thread
+    h = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    cached = _token_cache.get(h)
+    if cached and cached[0] > now:
+        return cached[1]
+    loop = asyncio.get_running_loop()
+    try:
+        idinfo = await loop.run_in_executor(None, decode_google_token, token)
     except Exception as e:
         print("Token verification failed:", e)
         return None
-
-
-def log_flagged(email, message, reason):
+    user = {
+        "email": idinfo.get("email"),
+        "name": idinfo.get("name", idinfo.get("email", "User")),
+        "pic": idinfo.get("picture", "")
+    }
+    now = time.time()
+    _prune_token_cache(now)
+    _token_cache[h] = (min(idinfo.get("exp", now), now + TOKEN_CACHE_TTL), user)
+    return user
+
+
+def write_log_batch(lines):
     try:
         with open(FLAGGED_LOG_PATH, "a", encoding="utf-8") as f:
-            f.write(f"{datetime.now()} | {email}: {message} | {reason}\n")
+            f.writelines(lines)
     except:
         pass
 
 
-def check_profanity_text(text):
-    return profanity.contains_profanity(text)
+async def log_writer():
+    """Append queued flagged-message lines to the log in batches, off the event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        lines = [await _log_q.get()]
+        while len(lines) < LOG_BATCH_SIZE and not _log_q.empty():
+            lines.append(_log_q.get_nowait())
+        await loop.run_in_executor(None, write_log_batch, lines)
 
 
-def check_hf_toxicity(text):
-    if not HF_API_KEY:
-        return True, "No moderation API key."
+def flush_log_queue():
+    lines = []
+    while not _log_q.empty():
+        lines.append(_log_q.get_nowait())
+    if lines:
+        write_log_batch(lines)
+
+
+def log_flagged(email, message, reason):
+    _log_q.put_nowait(f"{datetime.now()} | {email}: {message} | {reason}\n")
+
+
+def profanity_hits(t):
+    """(start, end, entries) for every censor word the folded automaton finds in t."""
+    for end, (length, entries) in PROFANITY_AUTOMATON.iter(t.translate(LEET_TABLE)):
+        yield end - length + 1, end, entries
+
+
+@lru_cache(maxsize=SAFETY_CACHE_SIZE)
+def check_profanity_text(text):
+    t = text.lower()
+    allowed = profanity.ALLOWED_CHARACTERS
+    for start, end, entries in profanity_hits(t):
+        # Only whole words count. An entry like "p.u.s.s.y." that starts or ends with a
+        # separator brings its own boundary on that side, so it is not checked there.
+        if start > 0 and t[start] in allowed and t[start - 1] in allowed:
+            continue
+        if end + 1 < len(t) and t[end] in allowed and t[end + 1] in allowed:
+            continue
+        # The fold is coarse; let the library's own variant matching decide
+        candidate = t[start:end + 1]
+        if any(entry == candidate for entry in entries):
+            return True
+
+    # Like better_profanity, also try each word joined with the next few words and the
+    # separators dropped, so "F-U-C-K$" and "A_$.$" are caught
+    spans = [m.span() for m in PROFANITY_WORD_RE.finditer(t)]
+    if len(spans) < 2:
+        return False
+    joined = "".join(t[a:b] for a, b in spans)
+    word_starts, word_ends = {}, {}
+    offset = 0
+    for i, (a, b) in enumerate(spans):
+        word_starts[offset] = i
+        offset += b - a
+        word_ends[offset - 1] = i
+    for start, end, entries in profanity_hits(joined):
+        if start not in word_starts or end not in word_ends:
+            continue
+        if word_ends[end] - word_starts[start] > profanity.MAX_NUMBER_COMBINATIONS:
+            continue
+        candidate = joined[start:end + 1]
+        if any(entry == candidate for entry in entries):
+            return True
+    return False
+
+
+def local_toxic_scores(texts):
+    enc = tox_tokenizer(texts, return_tensors="np", padding=True, truncation=True, max_length=256)
+    feed = {i.name: enc[i.name] for i in tox_session.get_inputs() if i.name in enc}
+    logits = tox_session.run(None, feed)[0]
+    return (1 / (1 + np.exp(-logits[:, tox_index]))).tolist()
+
+
+def hf_toxic_scores(texts):
     try:
-        r = http_requests.post(
+        r = _hf_session.post(
             "https://api-inference.huggingface.co/models/unitary/toxic-bert",
-            headers={"Authorization": f"Bearer {HF_API_KEY}"},
-            json={"inputs": text},
+            json={"inputs": texts},
             timeout=10,
         )
         result = r.json()
-        toxic_score = 0.0
-        if isinstance(result, list):
-            block = result[0] if result and isinstance(result[0], list) else result
+        scores = []
+        for block in result:
+            toxic_score = 0.0
             for item in block:
                 if item.get("label") == "toxic":
                     toxic_score = item.get("score", 0.0)
-        if toxic_score > 0.5:
-            return False, f"Toxicity flagged | Score: ({toxic_score:.2f}) | Blocked by Hugging Face Toxicity"
-        return True, "OK"
+            scores.append(toxic_score)
+        if len(scores) != len(texts):
+            raise ValueError(f"unexpected response: {result}")
+        return scores
     except Exception as e:
         print("HF moderation error:", e)
-        return True, "HF unavailable"
+        return [None] * len(texts)
+
 
+def toxicity_scores(texts):
+    if tox_session is not None:
+        return local_toxic_scores(texts)
+    return hf_toxic_scores(texts)
 
-def check_safe(text):
+
+async def tox_worker():
+    """Coalesce queued toxicity checks into batches of up to TOX_BATCH_SIZE."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _tox_queue.get()]
+        deadline = loop.time() + TOX_BATCH_WINDOW
+        while len(batch) < TOX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_tox_queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            scores = await loop.run_in_executor(None, toxicity_scores, [text for text, _ in batch])
+        except Exception as e:
+            print("Toxicity model error:", e)
+            scores = [None] * len(batch)
+        for (text, fut), score in zip(batch, scores):
+            if score is not None:
+                _tox_cache[text] = score
+                if len(_tox_cache) > SAFETY_CACHE_SIZE:
+                    _tox_cache.popitem(last=False)
+            if not fut.done():
+                fut.set_result(score)
+
+
+async def _submit_tox(text):
+    fut = asyncio.get_running_loop().create_future()
+    _tox_queue.put_nowait((text, fut))
+    return await fut
+
+
+async def check_hf_toxicity(text):
+    if tox_session is None and not HF_API_KEY:
+        return True, "No moderation API key."
+    toxic_score = _tox_cache.get(text)
+    if toxic_score is not None:
+        _tox_cache.move_to_end(text)
+    else:
+        toxic_score = await _submit_tox(text)
+    local = tox_session is not None
+    if toxic_score is None:
+        return True, "toxic-bert unavailable" if local else "HF unavailable"
+    if toxic_score > TOXICITY_THRESHOLD:
+        blocked_by = "toxic-bert" if local else "Hugging Face Toxicity"
+        return False, f"Toxicity flagged | Score: ({toxic_score:.2f}) | Blocked by {blocked_by}"
+    return True, "OK"
+
+
+# Words that make a short message worth sending to the toxicity model anyway
+TOXIC_HINT_WORDS = frozenset({
+    "idiot", "stupid", "dumb", "moron", "loser", "ugly", "fat", "hate", "kill",
+    "die", "dead", "kys", "trash", "worthless", "useless", "pathetic", "shut",
+    "suck", "sucks", "freak", "disgusting", "hurt", "murder", "threat",
+})
+
+
+def looks_harmless(text):
+    """Short plain-alphanumeric messages with no hint words skip the toxicity model."""
+    return (
+        len(text) < FAST_PATH_MAX_LEN
+        and text.isascii()
+        and text.replace(" ", "").isalnum()
+        and TOXIC_HINT_WORDS.isdisjoint(text.lower().split())
+    )
+
+
+async def check_safe(text):
     if check_profanity_text(text):
         return False, "Profanity detected"
-    return check_hf_toxicity(text)
+    if looks_harmless(text):
+        return True, "OK"
+    return await check_hf_toxicity(text)
 
 
-async def broadcast_json(obj, except_ws=None):
-    msg = json.dumps(obj)
-    for c in clients[:]:
-        if c != except_ws and c.open:
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def drain_send_queue(ws, queue):
+    try:
+        while True:
+            msg, frame, close = await queue.get()
+            if ws.state is not State.OPEN:
+                return
+            # transport, protocol.extensions and drain() are websockets internals, hence
+            # the version cap in requirements.txt; test_raw_frame_internals guards them.
+            if ws.protocol.extensions:
+                # Extensions (e.g. deflate) transform frames per connection. main() serves
+                # with compression=None, so this only runs if that is ever turned back on.
+                await ws.send(msg)
+            else:
+                ws.transport.write(frame)
+                await ws.drain()
+            if close:
+                await ws.close()
+                return
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def tick_clock():
+    """Refresh the shared chat timestamp every CLOCK_TICK seconds."""
+    global _now_iso
+    while True:
+        _now_iso = datetime.now(timezone.utc).isoformat()
+        await asyncio.sleep(CLOCK_TICK)
+
+
+def dumps(obj):
+    # Sent as str: websockets turns bytes into binary frames, the browser expects text
+    return orjson.dumps(obj).decode()
+
+
+def frame_message(msg, close=False):
+    # Frame the message once; every client gets the same unmasked server frame
+    return msg, Frame(Opcode.TEXT, msg.encode()).serialize(mask=False), close
+
+
+def drop_client(ws):
+    """Stop sending to ws and close it; handle_client's finally does the rest of the cleanup."""
+    send_queues.pop(ws, None)
+    task = send_tasks.pop(ws, None)
+    if task:
+        task.cancel()
+    spawn(ws.close())
+
+
+def enqueue(ws, item):
+    queue = send_queues.get(ws)
+    if queue is None:
+        return
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        # Clients too slow to keep up are dropped instead of holding up everyone else
+        drop_client(ws)
+
+
+async def send_to(ws, obj):
+    """Queue a message for one client, in order with the broadcasts it receives."""
+    enqueue(ws, frame_message(dumps(obj)))
+
+
+async def kick(ws, content):
+    """Send a kick notice after everything already queued for ws, then close it."""
+    enqueue(ws, frame_message(dumps({"type": "kick", "content": content}), close=True))
+    task = send_tasks.get(ws)
+    if task:
+        await asyncio.wait([task])
+    await ws.close()
+
+
+async def broadcast(msg, except_ws=None):
+    item = frame_message(msg)
+    stalled = []
+    for c, queue in send_queues.items():
+        if c != except_ws:
             try:
-                await c.send(msg)
-            except websockets.exceptions.ConnectionClosed:
-                await remove_client(c)
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                stalled.append(c)
+    for c in stalled:
+        drop_client(c)
+
+
+async def broadcast_json(obj, except_ws=None):
+    await broadcast(dumps(obj), except_ws)
+
+
+def get_user_list_msg():
+    global _user_list_cache
+    if _user_list_cache is None:
+        online = [{"name": u["name"], "email": u["email"], "pic": u["pic"]} for u in users.values()]
+        _user_list_cache = dumps({"type": "user_list", "users": online})
+    return _user_list_cache
 
 
 async def broadcast_user_list():
-    online = [{"name": u["name"], "email": u["email"], "pic": u["pic"]} for u in users.values()]
-    await broadcast_json({"type": "user_list", "users": online})
+    await broadcast(get_user_list_msg())
 
 
 async def broadcast_system(content):
@@ -116,112 +521,135 @@ async def broadcast_system(content):
 
 
 async def remove_client(ws):
+    global _user_list_cache
     if ws in clients:
         u = users.pop(ws, None)
         clients.remove(ws)
         unsafe_counts.pop(ws, None)
         rate_limit_counts.pop(ws, None)
-        last_message_times.pop(ws, None)
+        msg_times.pop(ws, None)
+        send_queues.pop(ws, None)
+        task = send_tasks.pop(ws, None)
+        if task:
+            task.cancel()
         if u:
+            _user_list_cache = None
+            online_emails.discard(u["email"])
             await broadcast_system(f"{u['name']} left the chat.")
         await broadcast_user_list()
 
 
+def allow_message(recent, now):
+    """Record a send at `now`, unless RATE_LIMIT_MESSAGES already went out in the window."""
+    while recent and recent[0] <= now - RATE_LIMIT_WINDOW:
+        recent.popleft()
+    if len(recent) >= RATE_LIMIT_MESSAGES:
+        return False
+    recent.append(now)
+    return True
+
+
 async def handle_client(ws):
-    clients.append(ws)
+    global _user_list_cache
+    clients.add(ws)
+    send_queues[ws] = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    send_tasks[ws] = asyncio.create_task(drain_send_queue(ws, send_queues[ws]))
     try:
         async for raw in ws:
+            # Dropped by drop_client while we were busy; stop reading and let finally clean up
+            if ws not in send_queues:
+                break
             try:
-                data = json.loads(raw)
-            except:
+                data = decode_client_msg(raw)
+            except msgspec.DecodeError:
+                # Ignored once signed in, but the first message must still be a valid auth
+                if ws not in users:
+                    await kick(ws, "Not authenticated.")
+                    return
                 continue
 
             # --- First message must be auth ---
-            if data.get("type") == "auth":
-                token = data.get("token")
-                user = verify_google_token(token)
+            if isinstance(data, AuthMsg):
+                user = await verify_google_token(data.token)
                 if not user or not user.get("email"):
-                    await ws.send(json.dumps({"type": "kick", "content": "Invalid Google Sign-In"}))
-                    await ws.close()
+                    await kick(ws, "Invalid Google Sign-In")
                     return
 
                 email = user["email"]
 
                 # banned?
                 if email in banned_emails:
-                    await ws.send(json.dumps({"type": "kick", "content": "You are banned."}))
-                    await ws.close()
+                    await kick(ws, "You are banned.")
                     return
 
                 # Already logged in?
-                if email in [u["email"] for u in users.values()]:
-                    await ws.send(json.dumps({"type": "kick", "content": "⚠️ This account is already active."}))
-                    await ws.close()
+                if email in online_emails:
+                    await kick(ws, "⚠️ This account is already active.")
                     return
 
+                if ws in users:
+                    online_emails.discard(users[ws]["email"])
                 users[ws] = user
+                online_emails.add(email)
+                _user_list_cache = None
                 unsafe_counts[ws] = 0
                 rate_limit_counts[ws] = 0
+                msg_times[ws] = deque(maxlen=RATE_LIMIT_MESSAGES)
                 await broadcast_system(f"{user['name']} joined the chat!")
                 await broadcast_user_list()
-                await ws.send(json.dumps({"type": "system", "content": "✅ Connected to SafeTalk"}))
+                await send_to(ws, {"type": "system", "content": "✅ Connected to SafeTalk"})
                 continue
 
             # Must be authed
             if ws not in users:
-                await ws.send(json.dumps({"type": "kick", "content": "Not authenticated."}))
-                await ws.close()
+                await kick(ws, "Not authenticated.")
                 return
 
             user = users[ws]
             email = user["email"]
             name = user["name"]
             pic = user["pic"]
-            now = datetime.utcnow()
 
             # --- Chat messages ---
-            if data.get("type") == "chat":
-                msg = data.get("content", "").strip()
+            if isinstance(data, ChatMsg):
+                msg = data.content.strip()
                 if not msg:
                     continue
                 if len(msg) > 200:
-                    await ws.send(json.dumps({"type": "warning", "content": "Message too long."}))
+                    await send_to(ws, {"type": "warning", "content": "Message too long."})
                     continue
 
                 # Rate limiting
-                last = last_message_times.get(ws)
-                if last and (now - last).total_seconds() < 1:
+                if not allow_message(msg_times[ws], time.monotonic()):
                     rate_limit_counts[ws] += 1
-                    await ws.send(json.dumps({"type": "warning", "content": "Too fast! Slow down."}))
+                    await send_to(ws, {"type": "warning", "content": "Too fast! Slow down."})
                     if rate_limit_counts[ws] >= 5:
                         banned_emails.add(email)
-                        await ws.send(json.dumps({"type": "kick", "content": "Banned for spamming."}))
-                        await ws.close()
+                        await kick(ws, "Banned for spamming.")
                         return
                     continue
-                last_message_times[ws] = now
 
                 # AI command
                 if msg.lower().startswith("/ai "):
                     prompt = msg[4:].strip()
-                    safe, reason = check_safe(prompt)
+                    safe, reason = await check_safe(prompt)
                     if not safe:
                         unsafe_counts[ws] += 1
                         log_flagged(email, prompt, reason)
-                        await ws.send(json.dumps({"type": "warning", "content": f"⚠️ AI prompt blocked: {reason}"}))
+                        await send_to(ws, {"type": "warning", "content": f"⚠️ AI prompt blocked: {reason}"})
                         if unsafe_counts[ws] >= 3:
                             banned_emails.add(email)
-                            await ws.send(json.dumps({"type": "kick", "content": "Banned for unsafe inputs."}))
-                            await ws.close()
+                            await kick(ws, "Banned for unsafe inputs.")
                         continue
                     try:
-                        response = client.chat.completions.create(
+                        response = await client.chat.completions.create(
                             model="gpt-3.5-turbo",
                             messages=[
                                 {"role": "system", "content": "You are a helpful, safe chatbot in SafeTalk."},
                                 {"role": "user", "content": prompt},
                             ],
                             max_tokens=150,
+                            timeout=15,
                         )
                         ai_reply = response.choices[0].message.content.strip()
                     except Exception as e:
@@ -232,12 +660,12 @@ async def handle_client(ws):
                         "sender": "AI",
                         "name": "AI",
                         "pic": "",
-                        "timestamp": now.isoformat(),
+                        "timestamp": _now_iso,
                     })
                     continue
 
                 # Normal user message
-                safe, reason = check_safe(msg)
+                safe, reason = await check_safe(msg)
                 if safe:
                     await broadcast_json({
                         "type": "chat",
@@ -245,16 +673,15 @@ async def handle_client(ws):
                         "sender": email,
                         "name": name,
                         "pic": pic,
-                        "timestamp": now.isoformat(),
+                        "timestamp": _now_iso,
                     })
                 else:
                     unsafe_counts[ws] += 1
                     log_flagged(email, msg, reason)
-                    await ws.send(json.dumps({"type": "warning", "content": f"⚠️ Blocked: {reason}"}))
+                    await send_to(ws, {"type": "warning", "content": f"⚠️ Blocked: {reason}"})
                     if unsafe_counts[ws] >= 3:
                         banned_emails.add(email)
-                        await ws.send(json.dumps({"type": "kick", "content": "Banned for repeated unsafe messages."}))
-                        await ws.close()
+                        await kick(ws, "Banned for repeated unsafe messages.")
                         return
 
     except websockets.exceptions.ConnectionClosed:
@@ -264,9 +691,20 @@ async def handle_client(ws):
 
 
 async def main():
+    global _tox_queue, _log_q
+    _tox_queue = asyncio.Queue()
+    _log_q = asyncio.Queue()
+    workers = [spawn(tox_worker()), spawn(log_writer()), spawn(tick_clock())]
     print(f"🚀 SafeTalk running on ws://{HOST}:{PORT}")
-    async with websockets.serve(handle_client, HOST, PORT):
-        await asyncio.Future()
+    try:
+        # Chat frames are tiny; skip per-connection deflate so a broadcast is not compressed once per client
+        async with websockets.serve(handle_client, HOST, PORT, compression=None):
+            await asyncio.Future()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        flush_log_queue()
 
 
 if __name__ == "__main__":
@@ -2,26 +2,452 @@
 import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("OPENAI_API_KEY", "test")  # AsyncOpenAI() refuses to start without one
+
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
 
 import pytest
-from server import check_profanity, check_cyberbullying
+import websockets
+from better_profanity import profanity
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+
+import server
+from server import check_profanity_text, check_safe, verify_google_token
+
 
 def test_check_profanity_clean():
-    result, prob = check_profanity("Hello, how are you?")
-    assert result is False
-    assert prob == 0.0
+    assert check_profanity_text("Hello, how are you?") is False
 
 def test_check_profanity_bad():
-    result, prob = check_profanity("shit")
-    assert result is True
-    assert prob == 1.0
+    assert check_profanity_text("shit") is True
 
-def test_check_cyberbullying_clean():
-    is_safe, reason = check_cyberbullying("Have a nice day!")
+def test_check_safe_clean(monkeypatch):
+    async def fake_toxicity(text):
+        return True, "OK"
+    monkeypatch.setattr(server, "check_hf_toxicity", fake_toxicity)
+    is_safe, reason = asyncio.run(check_safe("Have a nice day!"))
     assert is_safe is True
-    assert "approved" in reason.lower()
+    assert reason == "OK"
 
-def test_check_cyberbullying_profanity():
-    is_safe, reason = check_cyberbullying("fuck you")
+def test_check_safe_profanity():
+    is_safe, reason = asyncio.run(check_safe("fuck you"))
     assert is_safe is False
-    assert "profanity" in reason.lower()
\ No newline at end of file
+    assert "profanity" in reason.lower()
+
+
+# === Profanity parity with better_profanity ===
+def censor_word_variants(word):
+    """Every '*'-free CHARS_MAPPING spelling of word."""
+    mapping = profanity.CHARS_MAPPING
+    combos = [[c for c in mapping.get(ch, (ch,)) if c != "*"] for ch in word]
+    return {"".join(p) for p in itertools.product(*combos)}
+
+def single_substitutions(word):
+    """word itself and every spelling with one CHARS_MAPPING substitution."""
+    variants = {word}
+    for i, ch in enumerate(word):
+        for sub in profanity.CHARS_MAPPING.get(ch, ()):
+            variants.add(word[:i] + sub + word[i + 1:])
+    return variants
+
+def test_check_profanity_matches_better_profanity():
+    missed, extra = [], []
+    for entry in profanity.CENSOR_WORDSET:
+        word = str(entry)
+        # The library splits entries like "s.h.i.t." into several words and misses some
+        # of their variants; for those we only require catching everything it catches.
+        single_word = all(c in profanity.ALLOWED_CHARACTERS for c in word)
+        texts = censor_word_variants(word)
+        # Surrounding words and punctuation, which must not hide or create a match
+        for variant in single_substitutions(word):
+            texts.update((variant, f"so {variant}, right?!", f"hey!{variant}what"))
+        for text in texts:
+            ours = check_profanity_text(text)
+            theirs = profanity.contains_profanity(text)
+            if theirs and not ours:
+                missed.append(text)
+            elif ours and not theirs and single_word:
+                extra.append(text)
+    assert missed == []
+    assert extra == []
+
+@pytest.mark.parametrize("text", [
+    "c@ck", "wh@re", "cvnt", "pv55y", "shlt", "bltch", "s1ut", "f**k", "SH1T!", "what a bull shit",
+    "P.U.S.S.Y.WHAT!", "F-U-C-K$!YOU", "!!A_$.$!,,",
+])
+def test_check_profanity_leetspeak(text):
+    assert profanity.contains_profanity(text)
+    assert check_profanity_text(text) is True
+
+@pytest.mark.parametrize("text", [
+    "fog", "hello there", "class assignment", "passion", "assume", "Have a nice day!",
+])
+def test_check_profanity_whole_words_only(text):
+    assert not profanity.contains_profanity(text)
+    assert check_profanity_text(text) is False
+
+
+# === Rate limiting ===
+def test_rate_limit_rejects_burst():
+    recent = deque(maxlen=server.RATE_LIMIT_MESSAGES)
+    results = [server.allow_message(recent, i * 0.1) for i in range(server.RATE_LIMIT_MESSAGES + 1)]
+    assert results[:server.RATE_LIMIT_MESSAGES] == [True] * server.RATE_LIMIT_MESSAGES
+    assert results[server.RATE_LIMIT_MESSAGES] is False
+
+def test_rate_limit_rejects_steady_one_second_pace():
+    recent = deque(maxlen=server.RATE_LIMIT_MESSAGES)
+    results = [server.allow_message(recent, i * 1.01) for i in range(20)]
+    assert False in results
+
+def test_rate_limit_window_slides():
+    recent = deque(maxlen=server.RATE_LIMIT_MESSAGES)
+    for i in range(server.RATE_LIMIT_MESSAGES):
+        assert server.allow_message(recent, float(i))
+    assert server.allow_message(recent, 5.0) is False
+    assert server.allow_message(recent, server.RATE_LIMIT_WINDOW + 0.5) is True
+
+
+# === Google token cache ===
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def token_env(monkeypatch):
+    clock = FakeClock(1_000_000.0)
+    calls = []
+    idinfo = {"email": "a@gmail.com", "name": "A", "exp": clock.now + 3600}
+
+    def fake_decode(token):
+        calls.append(token)
+        return dict(idinfo)
+
+    monkeypatch.setattr(server, "_token_cache", {})
+    monkeypatch.setattr(server, "decode_google_token", fake_decode)
+    monkeypatch.setattr(server.time, "time", clock.time)
+    return clock, calls, idinfo
+
+def test_token_cache_hit_skips_decode(token_env):
+    clock, calls, _ = token_env
+    first = asyncio.run(server.verify_google_token("tok"))
+    second = asyncio.run(server.verify_google_token("tok"))
+    assert first == second == {"email": "a@gmail.com", "name": "A", "pic": ""}
+    assert calls == ["tok"]
+
+def test_token_cache_capped_at_ttl(token_env):
+    clock, calls, _ = token_env
+    asyncio.run(server.verify_google_token("tok"))
+    clock.now += server.TOKEN_CACHE_TTL - 1
+    asyncio.run(server.verify_google_token("tok"))
+    assert len(calls) == 1
+    clock.now += 2
+    asyncio.run(server.verify_google_token("tok"))
+    assert len(calls) == 2
+
+def test_token_cache_expires_with_token(token_env):
+    clock, calls, idinfo = token_env
+    idinfo["exp"] = clock.now + 60
+    asyncio.run(server.verify_google_token("tok"))
+    clock.now += 61
+    asyncio.run(server.verify_google_token("tok"))
+    assert len(calls) == 2
+
+def test_token_cache_skips_failures(monkeypatch):
+    def failing_decode(token):
+        raise ValueError("bad token")
+    monkeypatch.setattr(server, "_token_cache", {})
+    monkeypatch.setattr(server, "decode_google_token", failing_decode)
+    assert asyncio.run(server.verify_google_token("tok")) is None
+    assert server._token_cache == {}
+
+
+# === Google signing certs ===
+def make_signer(kid):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, kid)])
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder().subject_name(name).issuer_name(name)
+        .public_key(key.public_key()).serial_number(1)
+        .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    pem_key = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    return crypt.RSASigner.from_string(pem_key, key_id=kid), cert.public_bytes(serialization.Encoding.PEM).decode()
+
+@pytest.fixture(scope="module")
+def signers():
+    return {kid: make_signer(kid) for kid in ("k1", "k2", "k3")}
+
+class FakeCertsEndpoint:
+    def __init__(self, certs, max_age=None):
+        self.certs = certs
+        self.max_age = max_age
+        self.fetches = 0
+
+    def __call__(self, url, method="GET"):
+        self.fetches += 1
+        headers = {"Cache-Control": f"public, max-age={self.max_age}"} if self.max_age else {}
+        return SimpleNamespace(status=200, data=json.dumps(self.certs).encode(), headers=headers)
+
+@pytest.fixture
+def certs_env(monkeypatch, signers):
+    endpoint = FakeCertsEndpoint({"k1": signers["k1"][1]})
+    monkeypatch.setattr(server, "_google_certs", (0.0, 0.0, {}))
+    monkeypatch.setattr(server, "_google_request", endpoint)
+    monkeypatch.setattr(server, "GOOGLE_CLIENT_ID", "client-id")
+    return endpoint
+
+def google_token(signer, **claims):
+    now = int(datetime.now(timezone.utc).timestamp())
+    payload = {"iss": "https://accounts.google.com", "aud": "client-id", "email": "a@gmail.com",
+               "iat": now, "exp": now + 3600, **claims}
+    return jwt.encode(signer, payload).decode()
+
+def test_google_certs_reused_between_tokens(certs_env, signers):
+    signer, _ = signers["k1"]
+    assert server.decode_google_token(google_token(signer))["email"] == "a@gmail.com"
+    assert server.decode_google_token(google_token(signer, email="b@gmail.com"))["email"] == "b@gmail.com"
+    assert certs_env.fetches == 1
+
+def test_google_certs_honour_max_age(certs_env):
+    certs_env.max_age = 120
+    server.get_google_certs(1000.0)
+    server.get_google_certs(1119.0)
+    assert certs_env.fetches == 1
+    server.get_google_certs(1120.0)
+    assert certs_env.fetches == 2
+
+def test_google_certs_refetched_for_unknown_key_id(certs_env, signers):
+    new_signer, new_cert = signers["k2"]
+    server.get_google_certs(time.time() - server.GOOGLE_CERTS_MIN_REFRESH)
+    certs_env.certs = {"k2": new_cert}   # Google rotated its keys
+    assert server.decode_google_token(google_token(new_signer))["email"] == "a@gmail.com"
+    assert certs_env.fetches == 2
+    # A second unknown key id within the minute does not trigger another fetch
+    with pytest.raises(ValueError):
+        server.decode_google_token(google_token(signers["k3"][0]))
+    assert certs_env.fetches == 2
+
+def test_google_token_wrong_issuer_rejected(certs_env, signers):
+    signer, _ = signers["k1"]
+    with pytest.raises(ValueError, match="Wrong issuer"):
+        server.decode_google_token(google_token(signer, iss="https://evil.example.com"))
+
+
+# === Toxicity reasons ===
+@pytest.mark.parametrize("session, score, expected", [
+    (object(), 0.9, (False, "Toxicity flagged | Score: (0.90) | Blocked by toxic-bert")),
+    (object(), None, (True, "toxic-bert unavailable")),
+    (None, 0.9, (False, "Toxicity flagged | Score: (0.90) | Blocked by Hugging Face Toxicity")),
+    (None, None, (True, "HF unavailable")),
+])
+def test_toxicity_reason_names_the_backend(monkeypatch, session, score, expected):
+    async def fake_submit(text):
+        return score
+    monkeypatch.setattr(server, "tox_session", session)
+    monkeypatch.setattr(server, "HF_API_KEY", "hf-key")
+    monkeypatch.setattr(server, "_submit_tox", fake_submit)
+    monkeypatch.setattr(server, "_tox_cache", server.OrderedDict())
+    assert asyncio.run(server.check_hf_toxicity("you are awful")) == expected
+
+
+# === Toxicity fast path ===
+@pytest.mark.parametrize("text", ["hello", "gg", "hello how are you", "see you at 5"])
+def test_looks_harmless(text):
+    assert server.looks_harmless(text) is True
+
+@pytest.mark.parametrize("text", [
+    "you are stupid",                       # hint word
+    "I HATE you",                           # hint word, any case
+    "hi!",                                  # punctuation
+    "héllo",                                # non-ASCII
+    "this message is long enough to check",  # too long
+])
+def test_looks_harmless_sends_rest_to_model(text):
+    assert server.looks_harmless(text) is False
+
+
+# === End-to-end over a real socket ===
+async def fake_verify(token):
+    return {"email": f"{token}@gmail.com", "name": token, "pic": ""}
+
+async def recv_until(ws, done):
+    received = []
+    while True:
+        msg = json.loads(await asyncio.wait_for(ws.recv(), 5))
+        received.append(msg)
+        if done(msg):
+            return received
+
+@pytest.fixture
+def chat_server(monkeypatch):
+    monkeypatch.setattr(server, "verify_google_token", fake_verify)
+    monkeypatch.setattr(server, "_log_q", asyncio.Queue())
+
+    errors = []
+
+    async def handler(ws):
+        try:
+            await server.handle_client(ws)
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    async def serve(scenario):
+        async with websockets.serve(handler, "127.0.0.1", 0, compression=None) as srv:
+            port = srv.sockets[0].getsockname()[1]
+            await scenario(f"ws://127.0.0.1:{port}")
+        assert errors == []
+
+    return lambda scenario: asyncio.run(serve(scenario))
+
+async def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+def test_messages_to_a_client_stay_in_order(chat_server):
+    async def scenario(url):
+        async with websockets.connect(url) as alice:
+            await alice.send(json.dumps({"type": "auth", "token": "alice"}))
+            joined = await recv_until(alice, lambda m: "Connected" in m.get("content", ""))
+            assert [m["type"] for m in joined] == ["system", "user_list", "system"]
+            assert joined[0]["content"] == "alice joined the chat!"
+
+            await alice.send(json.dumps({"type": "chat", "content": "hello bob"}))
+            await alice.send(json.dumps({"type": "chat", "content": "shit"}))
+            chatted = await recv_until(alice, lambda m: m["type"] == "warning")
+            assert [m["type"] for m in chatted] == ["chat", "warning"]
+            assert chatted[0]["content"] == "hello bob"
+
+    chat_server(scenario)
+
+def test_kick_is_delivered_before_close(chat_server):
+    async def scenario(url):
+        async with websockets.connect(url) as first:
+            await first.send(json.dumps({"type": "auth", "token": "carol"}))
+            await recv_until(first, lambda m: "Connected" in m.get("content", ""))
+            async with websockets.connect(url) as second:
+                await second.send(json.dumps({"type": "auth", "token": "carol"}))
+                kicked = await recv_until(second, lambda m: m["type"] == "kick")
+                assert kicked[-1]["content"] == "⚠️ This account is already active."
+                with pytest.raises(websockets.exceptions.ConnectionClosedOK):
+                    await asyncio.wait_for(second.recv(), 5)
+
+    chat_server(scenario)
+
+@pytest.mark.parametrize("first, reason", [
+    ('{"type": "ping"}', "Not authenticated."),
+    ('{}', "Not authenticated."),
+    ('not json', "Not authenticated."),
+    ('{"type": "auth", "token": null}', "Invalid Google Sign-In"),
+])
+def test_first_message_must_be_auth(chat_server, monkeypatch, first, reason):
+    monkeypatch.setattr(server, "verify_google_token", verify_google_token)
+
+    async def scenario(url):
+        async with websockets.connect(url) as client:
+            await client.send(first)
+            kicked = await recv_until(client, lambda m: m["type"] == "kick")
+            assert kicked[-1]["content"] == reason
+
+    chat_server(scenario)
+
+def test_malformed_messages_ignored_once_signed_in(chat_server):
+    async def scenario(url):
+        async with websockets.connect(url) as gina:
+            await gina.send(json.dumps({"type": "auth", "token": "gina"}))
+            await recv_until(gina, lambda m: "Connected" in m.get("content", ""))
+            for raw in ('{"type": "ping"}', '{}', 'not json', '{"type": "chat", "content": null}'):
+                await gina.send(raw)
+            await gina.send(json.dumps({"type": "chat", "content": "still here"}))
+            chatted = await recv_until(gina, lambda m: m["type"] == "chat")
+            assert [m["content"] for m in chatted] == ["still here"]
+
+    chat_server(scenario)
+
+def test_drop_while_checking_a_message(chat_server, monkeypatch):
+    checking, release = asyncio.Event(), asyncio.Event()
+
+    async def slow_check(text):
+        checking.set()
+        await release.wait()
+        return False, "test"
+    monkeypatch.setattr(server, "check_safe", slow_check)
+
+    async def scenario(url):
+        async with websockets.connect(url) as erin:
+            await erin.send(json.dumps({"type": "auth", "token": "erin"}))
+            await recv_until(erin, lambda m: "Connected" in m.get("content", ""))
+            await erin.send(json.dumps({"type": "chat", "content": "hi"}))
+            await checking.wait()
+            server.drop_client(next(iter(server.clients)))
+            release.set()
+            await wait_until(lambda: not server.clients)
+        assert server.unsafe_counts == {}
+        assert server.online_emails == set()
+
+    chat_server(scenario)
+
+def test_drop_while_verifying_does_not_lock_the_account(chat_server, monkeypatch):
+    verifying, release = asyncio.Event(), asyncio.Event()
+
+    async def slow_verify(token):
+        if token == "slow":
+            verifying.set()
+            await release.wait()
+        return await fake_verify("frank")
+    monkeypatch.setattr(server, "verify_google_token", slow_verify)
+
+    async def scenario(url):
+        async with websockets.connect(url) as first:
+            await first.send(json.dumps({"type": "auth", "token": "slow"}))
+            await verifying.wait()
+            server.drop_client(next(iter(server.clients)))
+            release.set()
+            await wait_until(lambda: not server.clients)
+        assert server.online_emails == set()
+        async with websockets.connect(url) as second:
+            await second.send(json.dumps({"type": "auth", "token": "frank"}))
+            joined = await recv_until(second, lambda m: m["type"] == "kick" or "Connected" in m.get("content", ""))
+            assert "Connected" in joined[-1]["content"]
+
+    chat_server(scenario)
+
+def test_raw_frame_internals(chat_server):
+    # drain_send_queue writes pre-built frames below the public websockets API
+    async def scenario(url):
+        async with websockets.connect(url) as client:
+            await client.send(json.dumps({"type": "auth", "token": "dave"}))
+            await recv_until(client, lambda m: "Connected" in m.get("content", ""))
+            conn = next(iter(server.clients))
+            assert conn.state is server.State.OPEN
+            assert conn.protocol.extensions == []
+            assert callable(conn.transport.write)
+            assert asyncio.iscoroutinefunction(conn.drain)
+
+            msg = server.dumps({"type": "system", "content": "raw"})
+            _, frame, _ = server.frame_message(msg)
+            assert frame == b"\x81" + bytes([len(msg.encode())]) + msg.encode()
+            await server.broadcast(msg)
+            assert await asyncio.wait_for(client.recv(), 5) == msg
+
+    chat_server(scenario)